@@ -1,24 +1,117 @@
-from flask import Flask, render_template, request, jsonify, send_file
-from datetime import datetime
+from flask import Flask, Response, render_template, request, jsonify, send_file
+from flask.json.provider import JSONProvider
+import mimetypes
 import os
+import orjson
 from document_manager import DocumentManager
-from invoice_generator import InvoiceGenerator
+from invoice_generator import get_invoice_generator
 from digital_signature import DigitalSignature
 
+class OrjsonProvider(JSONProvider):
+    """Serialización JSON de la API con orjson (mucho más rápido que json)"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS),
+            mimetype='application/json'
+        )
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['INVOICE_FOLDER'] = 'invoices'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max
 
+# Tamaño máximo del cuerpo por endpoint (el resto usa DEFAULT_REQUEST_LIMIT)
+# Se rechaza con 413 antes de leer el cuerpo de la petición
+app.config['REQUEST_SIZE_LIMITS'] = {
+    'upload_document': 16 * 1024 * 1024,
+    'create_invoices_batch': 8 * 1024 * 1024,
+}
+app.config['DEFAULT_REQUEST_LIMIT'] = 1 * 1024 * 1024
+
+# Entrega de archivos delegada al servidor web (ver deploy/nginx.conf):
+# - nginx: prefijo de la location interna para X-Accel-Redirect (p. ej. /protected)
+# - Apache (mod_xsendfile): USE_X_SENDFILE=1
+app.config['X_ACCEL_REDIRECT_PREFIX'] = os.environ.get('X_ACCEL_REDIRECT_PREFIX', '')
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
+
 # Crear directorios necesarios
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['INVOICE_FOLDER'], exist_ok=True)
 
+# Campos requeridos en una factura según legislación vietnamita
+REQUIRED_INVOICE_FIELDS = ['seller_info', 'buyer_info', 'items', 'payment_method']
+
 # Inicializar módulos
 doc_manager = DocumentManager(app.config['UPLOAD_FOLDER'])
-invoice_gen = InvoiceGenerator(app.config['INVOICE_FOLDER'])
+invoice_gen = get_invoice_generator(app.config['INVOICE_FOLDER'])
 digital_sig = DigitalSignature()
 
+# Comprobación opcional de integridad de los documentos al arrancar
+if os.environ.get('VERIFY_DOCUMENTS_ON_STARTUP') == '1':
+    corrupted_documents = doc_manager.verify_integrity()
+    if corrupted_documents:
+        app.logger.warning(
+            'Documentos ausentes o modificados: %s', ', '.join(corrupted_documents)
+        )
+
+def send_stored_file(file_path, mimetype=None):
+    """
+    Envía un archivo almacenado como descarga
+    Con X-Accel-Redirect el worker solo responde cabeceras y nginx envía los bytes
+    La existencia del archivo no se comprueba aparte: los metadatos son la
+    referencia y, si el archivo falta, se devuelve None
+    """
+    prefix = app.config['X_ACCEL_REDIRECT_PREFIX']
+    if not prefix:
+        try:
+            return send_file(file_path, as_attachment=True, mimetype=mimetype)
+        except FileNotFoundError:
+            return None
+
+    filename = os.path.basename(file_path)
+    internal_path = os.path.relpath(file_path).replace(os.sep, '/')
+    return Response(
+        mimetype=mimetype or mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+        headers={
+            'X-Accel-Redirect': f"{prefix.rstrip('/')}/{internal_path}",
+            'Content-Disposition': f'attachment; filename="{filename}"'
+        }
+    )
+
+def snapshot_response(body, etag):
+    """Respuesta JSON ya serializada con ETag; 304 si el cliente tiene la versión actual"""
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+@app.before_request
+def reject_oversized_request():
+    """Rechaza con 413 según Content-Length, sin leer ni almacenar el cuerpo"""
+    if request.content_length is None:
+        return None
+    limit = app.config['REQUEST_SIZE_LIMITS'].get(
+        request.endpoint, app.config['DEFAULT_REQUEST_LIMIT']
+    )
+    if request.content_length > limit:
+        return jsonify({'error': 'Request too large'}), 413
+    return None
+
+@app.before_request
+def refresh_shared_state():
+    """Con varios workers, recarga los metadatos modificados por otros procesos"""
+    doc_manager.refresh()
+    invoice_gen.refresh()
+    digital_sig.refresh()
+
 @app.route('/')
 def index():
     """Página principal del sistema"""
@@ -39,8 +132,7 @@ def documents_page():
 @app.route('/documents/list', methods=['GET'])
 def list_documents():
     """API: Lista todos los documentos (JSON)"""
-    documents = doc_manager.list_all_documents()
-    return jsonify({'documents': documents})
+    return snapshot_response(*doc_manager.list_documents_snapshot())
 
 @app.route('/documents/upload', methods=['POST'])
 def upload_document():
@@ -71,8 +163,9 @@ def get_document(doc_id):
 def download_document(doc_id):
     """Descarga un documento"""
     file_path = doc_manager.get_document_path(doc_id)
-    if file_path and os.path.exists(file_path):
-        return send_file(file_path, as_attachment=True)
+    response = send_stored_file(file_path) if file_path else None
+    if response is not None:
+        return response
     return jsonify({'error': 'Document not found'}), 404
 
 @app.route('/documents/<doc_id>', methods=['DELETE'])
@@ -99,8 +192,7 @@ def invoices_page():
 @app.route('/invoices/list', methods=['GET'])
 def list_invoices():
     """API: Lista todas las facturas (JSON)"""
-    invoices = invoice_gen.list_all_invoices()
-    return jsonify({'invoices': invoices})
+    return snapshot_response(*invoice_gen.list_invoices_snapshot())
 
 @app.route('/invoices/create', methods=['POST'])
 def create_invoice():
@@ -108,22 +200,90 @@ def create_invoice():
     data = request.json
     
     # Validar datos requeridos según legislación vietnamita
-    required_fields = ['seller_info', 'buyer_info', 'items', 'payment_method']
-    if not all(field in data for field in required_fields):
+    if not all(field in data for field in REQUIRED_INVOICE_FIELDS):
         return jsonify({'error': 'Missing required fields'}), 400
     
     # Generar factura en formato XML y PDF
     invoice_data = invoice_gen.create_invoice(data)
     
-    # Firmar digitalmente la factura
-    xml_path = invoice_data['xml_path']
-    signed_xml = digital_sig.sign_xml_invoice(xml_path)
+    # Firmar digitalmente la factura en segundo plano
+    # (el estado se consulta en /invoices/<invoice_id>/status)
+    invoice_id = invoice_data['invoice_id']
+    invoice_gen.start_signing(invoice_id)
+    future = digital_sig.sign_xml_invoice_async(invoice_data['xml_path'])
+    future.add_done_callback(lambda f: record_invoice_signature(invoice_id, f))
     
-    invoice_data['signed'] = True
-    invoice_data['signature_timestamp'] = datetime.now().isoformat()
+    invoice_data['signed'] = False
+    invoice_data['status'] = 'signing'
     
     return jsonify(invoice_data)
 
+@app.route('/invoices/batch', methods=['POST'])
+def create_invoices_batch():
+    """Crea un lote de facturas (p. ej. cierre de periodo) y las firma juntas"""
+    data = request.json or {}
+    invoices = data.get('invoices') or []
+    
+    if not invoices or not all(
+        all(field in invoice for field in REQUIRED_INVOICE_FIELDS) for invoice in invoices
+    ):
+        return jsonify({'error': 'Missing required fields'}), 400
+    
+    # Los metadatos se guardan una sola vez para todo el lote
+    created = invoice_gen.create_invoices_batch(invoices)
+    
+    # Firmar todo el lote en segundo plano con una sola tarea
+    invoice_ids = [invoice['invoice_id'] for invoice in created]
+    for invoice_id in invoice_ids:
+        invoice_gen.start_signing(invoice_id, flush=False)
+    invoice_gen.flush()
+    future = digital_sig.sign_xml_invoices_bulk_async([invoice['xml_path'] for invoice in created])
+    future.add_done_callback(lambda f: record_batch_signatures(invoice_ids, f))
+    
+    for invoice in created:
+        invoice['signed'] = False
+        invoice['status'] = 'signing'
+    
+    return jsonify({'success': True, 'invoices': created})
+
+def apply_signature_result(invoice_id, signature_result, flush=True):
+    """Registra en la factura el resultado de su firma digital"""
+    if signature_result.get('success'):
+        invoice_gen.mark_signed(invoice_id, signature_result, flush=flush)
+    else:
+        invoice_gen.set_status(invoice_id, 'signature_failed', flush=flush)
+
+def record_invoice_signature(invoice_id, future):
+    """Callback de la firma en segundo plano de una factura"""
+    try:
+        signature_result = future.result()
+    except Exception:
+        signature_result = {}
+    apply_signature_result(invoice_id, signature_result)
+
+def record_batch_signatures(invoice_ids, future):
+    """Callback de la firma en segundo plano de un lote de facturas"""
+    try:
+        results = future.result()
+    except Exception:
+        results = [{} for _ in invoice_ids]
+    for invoice_id, signature_result in zip(invoice_ids, results):
+        apply_signature_result(invoice_id, signature_result, flush=False)
+    invoice_gen.flush()
+
+def resume_stalled_signatures():
+    """
+    Vuelve a firmar las facturas que quedaron en 'signing' porque el worker
+    que las firmaba se reinició (la tarea solo vivía en su pool de firma)
+    """
+    invoice_ids = invoice_gen.claim_stalled_signing()
+    if invoice_ids:
+        xml_paths = [invoice_gen.get_invoice_xml_path(invoice_id) for invoice_id in invoice_ids]
+        future = digital_sig.sign_xml_invoices_bulk_async(xml_paths)
+        future.add_done_callback(lambda f: record_batch_signatures(invoice_ids, f))
+
+resume_stalled_signatures()
+
 @app.route('/invoices/<invoice_id>', methods=['GET'])
 def get_invoice(invoice_id):
     """Obtiene una factura específica"""
@@ -132,20 +292,41 @@ def get_invoice(invoice_id):
         return jsonify(invoice)
     return jsonify({'error': 'Invoice not found'}), 404
 
+@app.route('/invoices/<invoice_id>/status', methods=['GET'])
+def get_invoice_status(invoice_id):
+    """Estado de una factura, incluida la firma digital en segundo plano"""
+    invoice = invoice_gen.get_invoice(invoice_id)
+    if not invoice:
+        return jsonify({'error': 'Invoice not found'}), 404
+    return jsonify({
+        'invoice_id': invoice_id,
+        'status': invoice.get('status'),
+        'is_signed': invoice.get('is_signed', False),
+        'signature_id': invoice.get('signature_id'),
+        'signature_timestamp': invoice.get('signature_timestamp'),
+        'pdf_status': invoice.get('pdf_status', 'ready')
+    })
+
 @app.route('/invoices/<invoice_id>/pdf', methods=['GET'])
 def download_invoice_pdf(invoice_id):
     """Descarga el PDF de una factura"""
+    invoice = invoice_gen.get_invoice(invoice_id)
+    if invoice and invoice.get('pdf_status') == 'pending':
+        return jsonify({'status': 'pdf_pending', 'message': 'El PDF se está generando'}), 202
+    # Ruta guardada en los metadatos (el PDF se genera ahora si se difirió)
     pdf_path = invoice_gen.get_invoice_pdf_path(invoice_id)
-    if pdf_path and os.path.exists(pdf_path):
-        return send_file(pdf_path, as_attachment=True)
+    response = send_stored_file(pdf_path) if pdf_path else None
+    if response is not None:
+        return response
     return jsonify({'error': 'Invoice PDF not found'}), 404
 
 @app.route('/invoices/<invoice_id>/xml', methods=['GET'])
 def download_invoice_xml(invoice_id):
     """Descarga el XML de una factura (formato requerido por autoridades)"""
     xml_path = invoice_gen.get_invoice_xml_path(invoice_id)
-    if xml_path and os.path.exists(xml_path):
-        return send_file(xml_path, as_attachment=True, mimetype='application/xml')
+    response = send_stored_file(xml_path, mimetype='application/xml') if xml_path else None
+    if response is not None:
+        return response
     return jsonify({'error': 'Invoice XML not found'}), 404
 
 # ============== MÓDULO DE FIRMA DIGITAL ==============
@@ -162,10 +343,13 @@ def sign_document():
     document_path = data.get('document_path')
     signer_info = data.get('signer_info')
     
-    if not document_path or not os.path.exists(document_path):
+    if not document_path:
         return jsonify({'error': 'Document not found'}), 404
     
+    # La existencia del archivo se comprueba al calcular su hash
     signature_result = digital_sig.sign_document(document_path, signer_info)
+    if 'error' in signature_result:
+        return jsonify(signature_result), 404
     return jsonify(signature_result)
 
 @app.route('/signature/verify', methods=['POST'])
@@ -180,7 +364,7 @@ def verify_signature():
 @app.route('/signature/list', methods=['GET'])
 def list_signatures():
     """Lista todas las firmas digitales"""
-    signatures = list(digital_sig.signatures.values())
+    signatures = digital_sig.list_signatures()
     return jsonify({'signatures': signatures})
 
 @app.route('/signature/document/<doc_id>', methods=['POST'])
@@ -202,7 +386,14 @@ def sign_specific_document(doc_id):
         'tax_code': data.get('signer_tax_code', 'TAX-CODE-001')
     }
     
-    signature_result = digital_sig.sign_document(document_path, signer_info)
+    # Reutilizar el hash SHA256 calculado al subir el documento
+    if doc.get('file_hash'):
+        signature_result = digital_sig.sign_hash(document_path, doc['file_hash'], signer_info)
+    else:
+        signature_result = digital_sig.sign_document(document_path, signer_info)
+    
+    if 'error' in signature_result:
+        return jsonify(signature_result), 404
     
     if signature_result.get('success'):
         signature_result['document_info'] = {
@@ -6,7 +6,22 @@ from cryptography.hazmat.backends import default_backend
 from cryptography import x509
 from cryptography.x509.oid import NameOID
 import base64
-import json
+import hashlib
+import orjson
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from storage import open_database
+
+# Tamaño de bloque para calcular hashes de documentos (1 MB)
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Firmante usado para las facturas electrónicas
+INVOICE_SIGNER_INFO = {
+    'name': 'Sistema de Facturación MiPyME',
+    'email': 'facturacion@mipyme.vn',
+    'tax_code': 'DEMO-TAX-CODE'
+}
 
 class DigitalSignature:
     """
@@ -20,8 +35,19 @@ class DigitalSignature:
         self.keys_folder = 'digital_keys'
         os.makedirs(self.keys_folder, exist_ok=True)
         self.signatures_file = os.path.join(self.keys_folder, 'signatures.json')
+        self.db_file = os.path.join(self.keys_folder, 'signatures.db')
+        self._db_lock = threading.Lock()
         self._load_signatures()
 
+        # Claves RSA ya parseadas (se cargan una sola vez)
+        self._private_key = None
+        self._public_key = None
+        self._keys_lock = threading.Lock()
+
+        # Pool para firmar fuera del hilo de la petición
+        # (cryptography libera el GIL durante la operación RSA)
+        self._sig_pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+
         # Generar par de claves si no existen
         self.private_key_path = os.path.join(self.keys_folder, 'private_key.pem')
         self.public_key_path = os.path.join(self.keys_folder, 'public_key.pem')
@@ -30,19 +56,157 @@ class DigitalSignature:
         if not os.path.exists(self.private_key_path):
             self._generate_keys()
 
+        # Precargar claves: firmar/verificar no accede a disco
+        self._load_private_key()
+        self._load_public_key()
+
     def _load_signatures(self):
-        """Carga registro de firmas"""
-        if os.path.exists(self.signatures_file):
-            with open(self.signatures_file, 'r', encoding='utf-8') as f:
-                self.signatures = json.load(f)
+        """Carga registro de firmas desde SQLite a memoria"""
+        self.db = open_database(self.db_file)
+        # Firma y hash se guardan como bytes (BLOB), sin base64 ni JSON
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS signature_records ('
+            'id TEXT PRIMARY KEY, doc_path TEXT NOT NULL, signer_json TEXT, '
+            'signature BLOB NOT NULL, doc_hash BLOB NOT NULL, ts TEXT, '
+            'algorithm TEXT, key_size INTEGER, status TEXT)'
+        )
+        self._migrate_legacy_signatures()
+        self.signatures = {}
+        # Índice secundario: ruta normalizada -> firma más reciente
+        self._by_path = {}
+        self._last_rowid = 0
+        self._read_signatures()
+
+    def _migrate_legacy_signatures(self):
+        """
+        Importa una sola vez las firmas de formatos anteriores
+        (tabla signatures con JSON o archivo signatures.json)
+        """
+        if self.db.execute('SELECT 1 FROM signature_records LIMIT 1').fetchone():
+            return
+
+        has_json_table = self.db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'signatures'"
+        ).fetchone()
+        if has_json_table:
+            records = [
+                orjson.loads(data)
+                for data, in self.db.execute('SELECT json FROM signatures ORDER BY rowid')
+            ]
+        elif os.path.exists(self.signatures_file):
+            with open(self.signatures_file, 'rb') as f:
+                records = list(orjson.loads(f.read()).values())
         else:
-            self.signatures = {}
-            self._save_signatures()
+            return
+
+        for record in records:
+            record['signature'] = base64.b64decode(record['signature'])
+            record['document_hash'] = base64.b64decode(record['document_hash'])
+
+        self.db.execute('BEGIN')
+        self.db.executemany(self._INSERT_SQL, map(self._record_to_row, records))
+        self.db.execute('COMMIT')
 
-    def _save_signatures(self):
-        """Guarda registro de firmas"""
-        with open(self.signatures_file, 'w', encoding='utf-8') as f:
-            json.dump(self.signatures, f, indent=2, ensure_ascii=False)
+    _INSERT_SQL = (
+        'INSERT OR REPLACE INTO signature_records '
+        '(id, doc_path, signer_json, signature, doc_hash, ts, algorithm, key_size, status) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'
+    )
+
+    def _record_to_row(self, record):
+        """Convierte un registro de firma en una fila de signature_records"""
+        signer = {
+            'name': record['signer_name'],
+            'email': record['signer_email'],
+            'tax_code': record['signer_tax_code']
+        }
+        return (
+            record['signature_id'],
+            record['document_path'],
+            orjson.dumps(signer).decode('utf-8'),
+            record['signature'],
+            record['document_hash'],
+            record['timestamp'],
+            record['algorithm'],
+            record['key_size'],
+            record['status']
+        )
+
+    def _row_to_record(self, row):
+        """Convierte una fila de signature_records en un registro de firma"""
+        sig_id, doc_path, signer_json, signature, doc_hash, ts, algorithm, key_size, status = row
+        signer = orjson.loads(signer_json) if signer_json else {}
+        return {
+            'signature_id': sig_id,
+            'document_path': doc_path,
+            'signer_name': signer.get('name', ''),
+            'signer_email': signer.get('email', ''),
+            'signer_tax_code': signer.get('tax_code', ''),
+            'signature': signature,
+            'document_hash': doc_hash,
+            'timestamp': ts,
+            'algorithm': algorithm,
+            'key_size': key_size,
+            'status': status
+        }
+
+    def _read_signatures(self):
+        """
+        Lee las firmas nuevas de SQLite (rowid mayor que el último leído)
+        y las incorpora al registro en memoria sin reemplazarlo, para no
+        perder firmas registradas que aún se están guardando
+        """
+        with self._db_lock:
+            # Antes del SELECT: un cambio posterior vuelve a disparar refresh()
+            self._data_version = self.db.execute('PRAGMA data_version').fetchone()[0]
+            rows = self.db.execute(
+                'SELECT rowid, id, doc_path, signer_json, signature, doc_hash, ts, '
+                'algorithm, key_size, status FROM signature_records '
+                'WHERE rowid > ? ORDER BY rowid',
+                (self._last_rowid,)
+            )
+            for rowid, *row in rows:
+                self._merge_signature(self._row_to_record(row))
+                self._last_rowid = rowid
+
+    def _merge_signature(self, record):
+        """Añade una firma leída de SQLite; el índice por ruta conserva la más reciente"""
+        signature_id = record['signature_id']
+        self.signatures[signature_id] = record
+        path = os.path.normpath(record['document_path'])
+        current = self.signatures.get(self._by_path.get(path))
+        if current is None or (current['timestamp'] or '') <= (record['timestamp'] or ''):
+            self._by_path[path] = signature_id
+
+    def refresh(self):
+        """Recarga las firmas si otro proceso (otro worker) registró nuevas"""
+        with self._db_lock:
+            changed = self.db.execute('PRAGMA data_version').fetchone()[0] != self._data_version
+        if changed:
+            self._read_signatures()
+
+    def _save_signature(self, record):
+        """Guarda una única firma en el registro"""
+        with self._db_lock:
+            self.db.execute(self._INSERT_SQL, self._record_to_row(record))
+
+    def _save_signatures(self, records):
+        """Guarda un lote de firmas en una sola transacción"""
+        with self._db_lock:
+            self.db.execute('BEGIN')
+            self.db.executemany(self._INSERT_SQL, map(self._record_to_row, records))
+            self.db.execute('COMMIT')
+
+    def list_signatures(self):
+        """Lista las firmas registradas (firma y hash codificados en base64)"""
+        return [
+            {
+                **sig,
+                'signature': base64.b64encode(sig['signature']).decode('utf-8'),
+                'document_hash': base64.b64encode(sig['document_hash']).decode('utf-8')
+            }
+            for sig in list(self.signatures.values())
+        ]
 
     def _generate_keys(self):
         """
@@ -91,40 +255,74 @@ class DigitalSignature:
             f.write(cert.public_bytes(serialization.Encoding.PEM))
 
     def _load_private_key(self):
-        """Carga la clave privada"""
-        with open(self.private_key_path, 'rb') as f:
-            return serialization.load_pem_private_key(
-                f.read(),
-                password=None,
-                backend=default_backend()
-            )
+        """Carga la clave privada (parseada una vez y reutilizada)"""
+        if self._private_key is None:
+            with self._keys_lock:
+                if self._private_key is None:
+                    with open(self.private_key_path, 'rb') as f:
+                        self._private_key = serialization.load_pem_private_key(
+                            f.read(),
+                            password=None,
+                            backend=default_backend()
+                        )
+        return self._private_key
 
     def _load_public_key(self):
-        """Carga la clave pública"""
-        with open(self.public_key_path, 'rb') as f:
-            return serialization.load_pem_public_key(
-                f.read(),
-                backend=default_backend()
-            )
+        """Carga la clave pública (parseada una vez y reutilizada)"""
+        if self._public_key is None:
+            with self._keys_lock:
+                if self._public_key is None:
+                    with open(self.public_key_path, 'rb') as f:
+                        self._public_key = serialization.load_pem_public_key(
+                            f.read(),
+                            backend=default_backend()
+                        )
+        return self._public_key
+
+    def _hash_document(self, document_path):
+        """
+        Calcula el hash SHA256 del documento leyendo por bloques
+        La memoria usada no depende del tamaño del archivo
+        """
+        digest = hashlib.sha256()
+        with open(document_path, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                digest.update(block)
+        return digest.digest()
 
     def sign_document(self, document_path, signer_info):
         """
         Firma digitalmente un documento
         Tipo 2: Firma digital pública según ETL 2023
         """
+        try:
+            document_hash = self._hash_document(document_path)
+        except FileNotFoundError:
+            return {'error': 'Document not found'}
+
+        return self._sign_digest(document_path, document_hash, signer_info)
+
+    def sign_hash(self, document_path, hex_hash, signer_info):
+        """
+        Firma un documento a partir de su hash SHA256 ya calculado (hex)
+        Evita volver a leer el archivo, p. ej. con el hash guardado al subirlo
+        """
+        # El archivo no se lee, pero la firma solo se registra si existe
         if not os.path.exists(document_path):
             return {'error': 'Document not found'}
 
-        # Leer contenido del documento
-        with open(document_path, 'rb') as f:
-            document_data = f.read()
+        document_hash = bytes.fromhex(hex_hash)
+        return self._sign_digest(document_path, document_hash, signer_info)
 
-        # Calcular hash del documento
-        digest = hashes.Hash(hashes.SHA256(), backend=default_backend())
-        digest.update(document_data)
-        document_hash = digest.finalize()
+    def _sign_digest(self, document_path, document_hash, signer_info):
+        """Firma el hash del documento y registra la firma"""
+        signature_data = self._create_signature(document_path, document_hash, signer_info)
+        self._register_signature(signature_data)
+        self._save_signature(signature_data)
+        return self._signature_result(signature_data)
 
-        # Firmar el hash con la clave privada
+    def _create_signature(self, document_path, document_hash, signer_info):
+        """Firma el hash con la clave privada y construye el registro de la firma"""
         private_key = self._load_private_key()
         signature = private_key.sign(
             document_hash,
@@ -135,33 +333,37 @@ class DigitalSignature:
             hashes.SHA256()
         )
 
-        # Codificar firma en base64
-        signature_b64 = base64.b64encode(signature).decode('utf-8')
-
-        # Guardar información de la firma
-        signature_id = f"SIG-{datetime.now().strftime('%Y%m%d%H%M%S')}"
-        signature_data = {
+        # Sufijo aleatorio: varias firmas en el mismo segundo no colisionan
+        now = datetime.now()
+        signature_id = f"SIG-{now.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        return {
             'signature_id': signature_id,
             'document_path': os.path.normpath(document_path),
             'signer_name': signer_info.get('name', ''),
             'signer_email': signer_info.get('email', ''),
             'signer_tax_code': signer_info.get('tax_code', ''),
-            'signature': signature_b64,
-            'document_hash': base64.b64encode(document_hash).decode('utf-8'),
-            'timestamp': datetime.now().isoformat(),
+            'signature': signature,
+            'document_hash': document_hash,
+            'timestamp': now.isoformat(),
             'algorithm': 'RSA-PSS-SHA256',
             'key_size': 2048,
             'status': 'valid'
         }
+
+    def _register_signature(self, signature_data):
+        """Añade la firma al registro en memoria y al índice por ruta"""
+        signature_id = signature_data['signature_id']
         self.signatures[signature_id] = signature_data
-        self._save_signatures()
+        self._by_path[signature_data['document_path']] = signature_id
 
+    def _signature_result(self, signature_data):
+        """Respuesta devuelta al firmar un documento"""
         return {
             'success': True,
-            'signature_id': signature_id,
-            'signature': signature_b64,
+            'signature_id': signature_data['signature_id'],
+            'signature': base64.b64encode(signature_data['signature']).decode('utf-8'),
             'timestamp': signature_data['timestamp'],
-            'signer': signer_info.get('name', ''),
+            'signer': signature_data['signer_name'],
             'message': 'Document signed successfully with Vietnamese digital signature standard'
         }
 
@@ -171,11 +373,10 @@ class DigitalSignature:
         Valida integridad y autenticidad según estándares vietnamitas
         """
         normalized_path = os.path.normpath(signed_document_path)
-        signature_data = None
-        for sig_id, sig in self.signatures.items():
-            if os.path.normpath(sig['document_path']) == normalized_path:
-                signature_data = sig
-                break
+        signature_id = self._by_path.get(normalized_path)
+        signature_data = self.signatures.get(signature_id) if signature_id else None
+        if signature_data and os.path.normpath(signature_data['document_path']) != normalized_path:
+            signature_data = None
 
         if not signature_data:
             return {
@@ -183,17 +384,18 @@ class DigitalSignature:
                 'error': 'No signature found for this document'
             }
 
-        # Leer contenido del documento
-        with open(signed_document_path, 'rb') as f:
-            document_data = f.read()
+        if not os.path.exists(signed_document_path):
+            return {
+                'valid': False,
+                'error': 'Document not found'
+            }
 
-        # Calcular hash del documento actual
-        digest = hashes.Hash(hashes.SHA256(), backend=default_backend())
-        digest.update(document_data)
-        current_hash = digest.finalize()
+        # Calcular siempre el hash del documento actual: una marca (mtime, tamaño)
+        # se puede restaurar tras modificar el archivo
+        current_hash = self._hash_document(signed_document_path)
 
         # Comparar con hash almacenado
-        stored_hash = base64.b64decode(signature_data['document_hash'])
+        stored_hash = signature_data['document_hash']
 
         if current_hash != stored_hash:
             return {
@@ -204,7 +406,7 @@ class DigitalSignature:
 
         # Verificar firma con clave pública
         try:
-            signature = base64.b64decode(signature_data['signature'])
+            signature = signature_data['signature']
             public_key = self._load_public_key()
             public_key.verify(
                 signature,
@@ -236,12 +438,51 @@ class DigitalSignature:
         Firma específicamente una factura XML
         Cumple con requisitos de facturación electrónica vietnamita
         """
-        signer_info = {
-            'name': 'Sistema de Facturación MiPyME',
-            'email': 'facturacion@mipyme.vn',
-            'tax_code': 'DEMO-TAX-CODE'
-        }
-        return self.sign_document(xml_path, signer_info)
+        return self.sign_document(xml_path, INVOICE_SIGNER_INFO)
+
+    def sign_xml_invoices_bulk(self, xml_paths, hex_hashes=None):
+        """
+        Firma un lote de facturas XML (p. ej. cierre de periodo)
+        Reutiliza la clave ya cargada y guarda todas las firmas en una sola
+        transacción. Con hex_hashes (SHA256 precalculados, en el mismo orden)
+        no se vuelven a leer los archivos.
+        Devuelve un resultado por factura, en el mismo orden que xml_paths
+        """
+        results = []
+        records = []
+        for idx, xml_path in enumerate(xml_paths):
+            if hex_hashes:
+                # El archivo no se lee: solo se comprueba que existe
+                if not os.path.exists(xml_path):
+                    results.append({'error': 'Document not found'})
+                    continue
+                document_hash = bytes.fromhex(hex_hashes[idx])
+            else:
+                try:
+                    document_hash = self._hash_document(xml_path)
+                except FileNotFoundError:
+                    results.append({'error': 'Document not found'})
+                    continue
+
+            signature_data = self._create_signature(xml_path, document_hash, INVOICE_SIGNER_INFO)
+            self._register_signature(signature_data)
+            records.append(signature_data)
+            results.append(self._signature_result(signature_data))
+
+        if records:
+            self._save_signatures(records)
+        return results
+
+    def sign_xml_invoices_bulk_async(self, xml_paths, hex_hashes=None):
+        """Firma un lote de facturas XML en segundo plano (devuelve un Future)"""
+        return self._sig_pool.submit(self.sign_xml_invoices_bulk, xml_paths, hex_hashes)
+
+    def sign_xml_invoice_async(self, xml_path):
+        """
+        Firma una factura XML en segundo plano
+        Devuelve un Future con el resultado de sign_xml_invoice
+        """
+        return self._sig_pool.submit(self.sign_xml_invoice, xml_path)
 
     def get_pending_count(self):
         """Simula documentos pendientes de firma"""
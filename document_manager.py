@@ -1,9 +1,28 @@
 import os
-import json
+import re
+import orjson
 import uuid
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from werkzeug.utils import secure_filename
 import hashlib
+from storage import open_database, import_legacy_json
+
+# Tamaño de bloque para calcular hashes de archivos (1 MB)
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Cambios recientes que se conservan para la recarga incremental entre workers
+DOCUMENT_CHANGES_KEEP = 10000
+
+_TOKEN_RE = re.compile(r'\w+')
+
+
+def _tokenize(text):
+    """Divide un texto en tokens en minúsculas para el índice de búsqueda"""
+    return _TOKEN_RE.findall(text.lower())
+
 
 class DocumentManager:
     """
@@ -14,6 +33,13 @@ class DocumentManager:
     def __init__(self, upload_folder):
         self.upload_folder = upload_folder
         self.metadata_file = os.path.join(upload_folder, 'metadata.json')
+        self.db_file = os.path.join(upload_folder, 'metadata.db')
+        # Protege el estado en memoria y la base de datos entre hilos
+        self._lock = threading.RLock()
+        # Lista serializada en caché (se reconstruye cuando _dirty es True)
+        self._cache_bytes = None
+        self._cache_etag = None
+        self._dirty = True
         self.allowed_extensions = {
             'pdf', 'doc', 'docx', 'xls', 'xlsx', 
             'txt', 'jpg', 'jpeg', 'png', 'zip'
@@ -21,38 +47,225 @@ class DocumentManager:
         self._load_metadata()
     
     def _load_metadata(self):
-        """Carga metadatos de documentos"""
-        if os.path.exists(self.metadata_file):
-            with open(self.metadata_file, 'r', encoding='utf-8') as f:
-                self.documents = json.load(f)
-        else:
-            self.documents = {}
-            self._save_metadata()
+        """Carga metadatos de documentos desde SQLite a memoria"""
+        self.db = open_database(self.db_file)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS documents (id TEXT PRIMARY KEY, json TEXT NOT NULL)'
+        )
+        # Registro de ids modificados (lo llenan los triggers en cada escritura)
+        # para que los demás workers recarguen solo esos documentos
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS document_changes '
+            '(seq INTEGER PRIMARY KEY AUTOINCREMENT, doc_id TEXT NOT NULL)'
+        )
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            row = 'OLD' if event == 'DELETE' else 'NEW'
+            self.db.execute(
+                f'CREATE TRIGGER IF NOT EXISTS documents_{event.lower()} AFTER {event} ON documents '
+                f'BEGIN INSERT INTO document_changes (doc_id) VALUES ({row}.id); END'
+            )
+        # Migración desde el antiguo metadata.json
+        import_legacy_json(self.db, 'documents', self.metadata_file)
+        self._read_documents()
+    
+    def _read_documents(self):
+        """Lee todos los documentos de SQLite y reconstruye los índices"""
+        with self._lock:
+            # Primero la versión y el último cambio: lo escrito después
+            # se vuelve a leer en refresh
+            self._data_version = self.db.execute('PRAGMA data_version').fetchone()[0]
+            self._change_seq = self._last_change_seq()
+            self.documents = {
+                doc_id: orjson.loads(data)
+                for doc_id, data in self.db.execute('SELECT id, json FROM documents ORDER BY rowid')
+            }
+            self._build_index()
+            self._check_files()
+            self._dirty = True
+    
+    def _last_change_seq(self):
+        """Número del último cambio registrado en document_changes"""
+        return self.db.execute('SELECT MAX(seq) FROM document_changes').fetchone()[0] or 0
+    
+    def _check_files(self):
+        """
+        Marca los documentos cuyo archivo no está en disco
+        Una sola pasada con os.scandir al cargar; después los metadatos
+        son la referencia y no se hace stat por petición
+        """
+        stored_files = {entry.name for entry in os.scandir(self.upload_folder) if entry.is_file()}
+        self._missing_files = {
+            doc_id for doc_id, doc in self.documents.items()
+            if doc['stored_filename'] not in stored_files
+        }
+    
+    def refresh(self):
+        """
+        Recarga los metadatos si otro proceso (otro worker) los modificó
+        PRAGMA data_version solo cambia con escrituras de otras conexiones;
+        solo se vuelven a leer e indexar los documentos cambiados
+        """
+        with self._lock:
+            if self.db.execute('PRAGMA data_version').fetchone()[0] == self._data_version:
+                return
+            first_seq = self.db.execute('SELECT MIN(seq) FROM document_changes').fetchone()[0]
+            if first_seq is not None and first_seq > self._change_seq + 1:
+                # Los cambios pendientes ya se purgaron: recarga completa
+                self._read_documents()
+                return
+            self._data_version = self.db.execute('PRAGMA data_version').fetchone()[0]
+            rows = self.db.execute(
+                'SELECT seq, doc_id FROM document_changes WHERE seq > ? ORDER BY seq',
+                (self._change_seq,)
+            ).fetchall()
+            changed_ids = set()
+            for seq, doc_id in rows:
+                changed_ids.add(doc_id)
+                self._change_seq = seq
+            for doc_id in changed_ids:
+                self._reload_document(doc_id)
+            if changed_ids:
+                self._dirty = True
+    
+    def _reload_document(self, doc_id):
+        """Vuelve a leer un documento de SQLite y actualiza los índices"""
+        old = self.documents.pop(doc_id, None)
+        if old:
+            self._unindex_document(old)
+        self._missing_files.discard(doc_id)
+        row = self.db.execute('SELECT json FROM documents WHERE id = ?', (doc_id,)).fetchone()
+        if row is None:
+            return
+        doc = orjson.loads(row[0])
+        self.documents[doc_id] = doc
+        self._index_document(doc)
+        if not os.path.exists(os.path.join(self.upload_folder, doc['stored_filename'])):
+            self._missing_files.add(doc_id)
+    
+    def _build_index(self):
+        """Construye el índice invertido (token -> ids) y el índice por categoría"""
+        self._index = defaultdict(set)
+        self._by_category = defaultdict(set)
+        for doc in self.documents.values():
+            self._index_document(doc)
     
-    def _save_metadata(self):
-        """Guarda metadatos de documentos"""
-        with open(self.metadata_file, 'w', encoding='utf-8') as f:
-            json.dump(self.documents, f, indent=2, ensure_ascii=False)
+    def _document_tokens(self, doc):
+        """Tokens de título, descripción y tags de un documento"""
+        tokens = set(_tokenize(doc['title']))
+        tokens.update(_tokenize(doc['description']))
+        for tag in doc['tags']:
+            tokens.update(_tokenize(tag))
+        return tokens
     
-    def _allowed_file(self, filename):
-        """Verifica si el archivo tiene extensión permitida"""
-        return '.' in filename and \
-               filename.rsplit('.', 1)[1].lower() in self.allowed_extensions
+    def _index_document(self, doc):
+        """Añade un documento a los índices de búsqueda"""
+        for token in self._document_tokens(doc):
+            self._index[token].add(doc['id'])
+        self._by_category[doc['category']].add(doc['id'])
+    
+    def _unindex_document(self, doc):
+        """Quita un documento de los índices de búsqueda"""
+        for token in self._document_tokens(doc):
+            ids = self._index.get(token)
+            if ids is not None:
+                ids.discard(doc['id'])
+                if not ids:
+                    del self._index[token]
+        ids = self._by_category.get(doc['category'])
+        if ids is not None:
+            ids.discard(doc['id'])
+    
+    def _save_document(self, doc_id):
+        """Guarda los metadatos de un único documento"""
+        with self._lock:
+            self._dirty = True
+            self.db.execute(
+                'INSERT OR REPLACE INTO documents (id, json) VALUES (?, ?)',
+                (doc_id, orjson.dumps(self.documents[doc_id]).decode('utf-8'))
+            )
+            self._prune_changes()
+    
+    def _prune_changes(self):
+        """Conserva solo los últimos DOCUMENT_CHANGES_KEEP cambios registrados"""
+        self.db.execute(
+            'DELETE FROM document_changes WHERE seq <= '
+            '(SELECT MAX(seq) FROM document_changes) - ?',
+            (DOCUMENT_CHANGES_KEEP,)
+        )
+    
+    def _remove_document(self, doc_id):
+        """Elimina los metadatos de un documento"""
+        with self._lock:
+            self._dirty = True
+            self.db.execute('DELETE FROM documents WHERE id = ?', (doc_id,))
+    
+    def _allowed_extension(self, filename):
+        """Devuelve la extensión del archivo si está permitida, o None"""
+        _, dot, extension = filename.rpartition('.')
+        extension = extension.lower()
+        if dot and extension in self.allowed_extensions:
+            return extension
+        return None
     
     def _calculate_hash(self, file_path):
         """Calcula hash SHA256 del archivo para integridad"""
-        sha256_hash = hashlib.sha256()
         with open(file_path, "rb") as f:
-            for byte_block in iter(lambda: f.read(4096), b""):
+            if hasattr(hashlib, 'file_digest'):  # Python 3.11+
+                return hashlib.file_digest(f, 'sha256').hexdigest()
+            sha256_hash = hashlib.sha256()
+            for byte_block in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
                 sha256_hash.update(byte_block)
         return sha256_hash.hexdigest()
     
+    def _hash_if_exists(self, file_path):
+        """Hash SHA256 del archivo, o None si no se puede leer"""
+        try:
+            return self._calculate_hash(file_path)
+        except OSError:
+            return None
+    
+    def bulk_hash(self, paths):
+        """
+        Calcula en paralelo el SHA256 de varios archivos
+        hashlib libera el GIL, así que basta con un pool de hilos
+        """
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+            return list(pool.map(self._hash_if_exists, paths))
+    
+    def verify_integrity(self):
+        """
+        Comprueba que los archivos en disco coinciden con el hash guardado
+        Devuelve los ids de los documentos ausentes o modificados
+        """
+        documents = list(self.documents.values())
+        paths = [os.path.join(self.upload_folder, doc['stored_filename']) for doc in documents]
+        return [
+            doc['id']
+            for doc, file_hash in zip(documents, self.bulk_hash(paths))
+            if file_hash != doc.get('file_hash')
+        ]
+    
+    def _save_and_hash(self, file, file_path):
+        """
+        Escribe el archivo subido por bloques calculando su SHA256 a la vez
+        Evita volver a leer el archivo completo tras guardarlo
+        """
+        sha256_hash = hashlib.sha256()
+        file_size = 0
+        with open(file_path, "wb") as out:
+            for chunk in iter(lambda: file.stream.read(HASH_CHUNK_SIZE), b""):
+                sha256_hash.update(chunk)
+                out.write(chunk)
+                file_size += len(chunk)
+        return sha256_hash.hexdigest(), file_size
+    
     def upload_document(self, file, metadata):
         """Sube un documento con metadatos"""
         if not file or file.filename == '':
             return {'error': 'No file selected'}
         
-        if not self._allowed_file(file.filename):
+        file_extension = self._allowed_extension(file.filename)
+        if not file_extension:
             return {'error': 'File type not allowed'}
         
         # Generar ID único
@@ -60,17 +273,14 @@ class DocumentManager:
         
         # Guardar archivo con nombre seguro
         original_filename = secure_filename(file.filename)
-        file_extension = original_filename.rsplit('.', 1)[1].lower()
         new_filename = f"{doc_id}.{file_extension}"
         file_path = os.path.join(self.upload_folder, new_filename)
         
-        file.save(file_path)
-        
-        # Calcular hash para integridad
-        file_hash = self._calculate_hash(file_path)
+        # Guardar y calcular hash para integridad en una sola pasada
+        file_hash, file_size = self._save_and_hash(file, file_path)
         
         # Guardar metadatos
-        self.documents[doc_id] = {
+        document = {
             'id': doc_id,
             'original_filename': original_filename,
             'stored_filename': new_filename,
@@ -79,13 +289,16 @@ class DocumentManager:
             'description': metadata.get('description', ''),
             'tags': metadata.get('tags', []),
             'upload_date': datetime.now().isoformat(),
-            'file_size': os.path.getsize(file_path),
+            'file_size': file_size,
             'file_hash': file_hash,
             'file_extension': file_extension,
             'version': 1
         }
         
-        self._save_metadata()
+        with self._lock:
+            self.documents[doc_id] = document
+            self._save_document(doc_id)
+            self._index_document(document)
         
         return {
             'success': True,
@@ -100,46 +313,83 @@ class DocumentManager:
     def get_document_path(self, doc_id):
         """Obtiene la ruta física del documento"""
         doc = self.documents.get(doc_id)
-        if doc:
+        if doc and doc_id not in self._missing_files:
             return os.path.join(self.upload_folder, doc['stored_filename'])
         return None
     
+    def list_documents_snapshot(self):
+        """
+        Lista de documentos serializada en JSON y su ETag
+        Solo se vuelve a serializar si los documentos cambiaron
+        """
+        with self._lock:
+            if self._dirty:
+                self._cache_bytes = orjson.dumps({'documents': list(self.documents.values())})
+                self._cache_etag = hashlib.sha256(self._cache_bytes).hexdigest()
+                self._dirty = False
+            return self._cache_bytes, self._cache_etag
+    
     def list_all_documents(self):
         """Lista todos los documentos"""
         return list(self.documents.values())
     
     def search_documents(self, query, category=''):
         """Busca documentos por texto o categoría"""
-        results = []
-        query_lower = query.lower()
+        with self._lock:
+            return self._search(query, category)
+    
+    def _search(self, query, category):
+        """Búsqueda sobre los índices (se llama con self._lock tomado)"""
+        if category:
+            scope = self._by_category.get(category, set())
+        else:
+            scope = self.documents.keys()
         
-        for doc in self.documents.values():
-            match = False
-            
-            # Buscar en título, descripción y tags
-            if (query_lower in doc['title'].lower() or
-                query_lower in doc['description'].lower() or
-                any(query_lower in tag.lower() for tag in doc['tags'])):
-                match = True
-            
-            # Filtrar por categoría si se especifica
-            if category and doc['category'] != category:
-                match = False
-            
-            if match:
-                results.append(doc)
+        query_tokens = _tokenize(query)
         
+        if not query:
+            candidates = set(scope)
+        else:
+            if query_tokens:
+                # Prefiltro con el índice: cada palabra de la consulta puede ser
+                # prefijo o fragmento de un token indexado (unión de sus ids)
+                candidates = set(scope)
+                for query_token in query_tokens:
+                    matching = set()
+                    for token, ids in self._index.items():
+                        if query_token in token:
+                            matching |= ids
+                    candidates &= matching
+            else:
+                candidates = scope
+            # Confirmar con la búsqueda por subcadena sobre los candidatos
+            query_lower = query.lower()
+            candidates = {
+                doc_id for doc_id in candidates
+                if self._matches_substring(self.documents[doc_id], query_lower)
+            }
+        
+        results = [self.documents[doc_id] for doc_id in candidates]
+        results.sort(key=lambda doc: doc['upload_date'])
         return results
     
+    def _matches_substring(self, doc, query_lower):
+        """Busca el texto en título, descripción y tags"""
+        return (query_lower in doc['title'].lower() or
+                query_lower in doc['description'].lower() or
+                any(query_lower in tag.lower() for tag in doc['tags']))
+    
     def delete_document(self, doc_id):
         """Elimina un documento"""
-        doc = self.documents.get(doc_id)
+        with self._lock:
+            doc = self.documents.pop(doc_id, None)
+            if doc:
+                self._unindex_document(doc)
+                self._remove_document(doc_id)
         if doc:
-            file_path = self.get_document_path(doc_id)
+            file_path = os.path.join(self.upload_folder, doc['stored_filename'])
             if os.path.exists(file_path):
                 os.remove(file_path)
-            del self.documents[doc_id]
-            self._save_metadata()
             return {'success': True}
         return {'error': 'Document not found'}
     
@@ -0,0 +1,20 @@
+# Configuración de gunicorn para producción
+# Uso: gunicorn (o gunicorn wsgi:app)
+#
+# Workers con hilos (gthread): mientras un hilo espera E/S de disco
+# (subida y hash de archivos, lectura de documentos a firmar, descargas)
+# los demás hilos del mismo worker siguen atendiendo peticiones.
+import multiprocessing
+import os
+
+wsgi_app = 'wsgi:app'
+
+# nginx se conecta por socket Unix (ver deploy/nginx.conf)
+bind = os.environ.get('GUNICORN_BIND', 'unix:/run/mipyme.sock')
+
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = 4
+
+# Conexiones keep-alive con nginx
+keepalive = 15
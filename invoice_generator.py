@@ -1,14 +1,233 @@
 import os
-import json
+import mmap
+import multiprocessing
+import orjson
 import uuid
+import hashlib
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
+from reportlab import rl_config
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.units import mm
 from reportlab.pdfgen import canvas
 from reportlab.lib import colors
 from reportlab.platypus import Table, TableStyle
-import xml.etree.ElementTree as ET
-from xml.dom import minidom
+from lxml import etree
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin bloqueo del log entre procesos
+    fcntl = None
+
+# Tamaño del log a partir del cual se compacta en el snapshot
+LOG_COMPACT_BYTES = 4 * 1024 * 1024
+
+# Procesos para generar PDF por worker de gunicorn (pocos: hay varios workers)
+PDF_WORKERS = int(os.environ.get('PDF_WORKERS', 2))
+
+# Los procesos del pool no se crean con fork: no heredan hilos ni conexiones
+PDF_MP_CONTEXT = (
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+)
+
+# Sin validación de argumentos en cada primitiva gráfica de ReportLab
+rl_config.shapeChecking = 0
+
+# Archivos que se generan al crear una factura; el resto, al pedir su ruta
+EAGER_FILES = ('xml', 'pdf')
+
+# Espacio de nombres de la factura electrónica
+XML_NAMESPACE = 'http://www.gdt.gov.vn/einvoice'
+XML_NSMAP = {None: XML_NAMESPACE}
+
+# Tabla de productos/servicios: encabezados, anchos de columna y estilo
+PDF_TABLE_HEADERS = ["#", "Descripción", "Cant.", "Precio Unit.", "Total"]
+PDF_TABLE_COL_WIDTHS = [30, 220, 50, 100, A4[0] - 500]
+PDF_TABLE_STYLE = TableStyle([
+    ('FONT', (0, 0), (-1, 0), 'Helvetica-Bold', 10),
+    ('FONT', (0, 1), (-1, -1), 'Helvetica', 9),
+    ('LINEBELOW', (0, 0), (-1, 0), 1, colors.black),
+    ('VALIGN', (0, 0), (-1, -1), 'BOTTOM'),
+    ('LEFTPADDING', (0, 0), (-1, -1), 0),
+    ('RIGHTPADDING', (0, 0), (-1, -1), 0),
+    ('TOPPADDING', (0, 0), (-1, -1), 0),
+    ('BOTTOMPADDING', (0, 0), (-1, 0), 6),
+    ('BOTTOMPADDING', (0, 1), (-1, -1), 3),
+])
+# Límite inferior de la tabla antes de continuar en otra página
+PDF_TABLE_BOTTOM = 150
+
+# Formato de importes en el PDF (1,234.50)
+format_money = '{:,.2f}'.format
+
+# Precisión de los importes monetarios
+MONEY_QUANTUM = Decimal('0.01')
+
+def to_money(value):
+    """Redondea un importe Decimal a céntimos"""
+    return value.quantize(MONEY_QUANTUM, rounding=ROUND_HALF_UP)
+
+def _xml_tag(name):
+    """Nombre calificado de un elemento en el espacio de nombres de la factura"""
+    return f'{{{XML_NAMESPACE}}}{name}'
+
+def _draw_pdf_layout(c):
+    """
+    Dibuja la maquetación fija de la primera página
+    (título, encabezados de sección y separadores)
+    """
+    width, height = A4
+    c.setFont("Helvetica-Bold", 20)
+    c.drawString(50, height - 50, "FACTURA ELECTRÓNICA / E-INVOICE")
+    c.line(50, height - 110, width - 50, height - 110)
+    c.setFont("Helvetica-Bold", 12)
+    c.drawString(50, height - 140, "VENDEDOR:")
+    c.drawString(50, height - 240, "CLIENTE:")
+    c.setFont("Helvetica-Bold", 10)
+    c.drawString(50, height - 330, "DETALLE DE PRODUCTOS/SERVICIOS:")
+
+def _draw_items_table(c, items, top):
+    """
+    Dibuja la tabla de productos/servicios desde la altura top
+    La tabla se divide entre páginas repitiendo los encabezados
+    Devuelve la altura donde termina la tabla
+    """
+    width, height = A4
+    # Columnas formateadas de una vez; cada fila solo agrupa textos ya hechos
+    prices = map(format_money, [item['unit_price'] for item in items])
+    amounts = map(format_money, [item['amount'] for item in items])
+    rows = [PDF_TABLE_HEADERS]
+    rows.extend(
+        [str(idx), item['description'][:30], str(item['quantity']), price, amount]
+        for idx, (item, price, amount) in enumerate(zip(items, prices, amounts), 1)
+    )
+    table = Table(rows, colWidths=PDF_TABLE_COL_WIDTHS,
+                  rowHeights=[20] + [15] * (len(rows) - 1), repeatRows=1)
+    table.setStyle(PDF_TABLE_STYLE)
+    table_width = width - 100
+    
+    while True:
+        avail = top - PDF_TABLE_BOTTOM
+        _, table_height = table.wrapOn(c, table_width, avail)
+        if table_height <= avail:
+            table.drawOn(c, 50, top - table_height)
+            return top - table_height
+        # Nueva página: se dibuja lo que cabe y se continúa con el resto
+        first, table = table.splitOn(c, table_width, avail)
+        _, first_height = first.wrapOn(c, table_width, avail)
+        first.drawOn(c, 50, top - first_height)
+        c.showPage()
+        top = height - 50
+
+def _draw_text_block(c, y, lines, font_size=10):
+    """
+    Dibuja líneas consecutivas (interlineado 15) en un solo objeto de texto
+    Un bloque BT/ET en lugar de uno por cada drawString
+    """
+    text = c.beginText(50, y)
+    text.setFont("Helvetica", font_size, leading=15)
+    text.textLines(lines, trim=0)
+    c.drawText(text)
+
+def _generate_pdf_standalone(invoice_id, data, invoice_folder):
+    """
+    Genera PDF de la factura para el cliente
+    Función de módulo para poder ejecutarse en un proceso del pool de PDFs;
+    el archivo se escribe aparte y se renombra al terminar
+    """
+    pdf_path = os.path.join(invoice_folder, f"{invoice_id}.pdf")
+    tmp_path = f"{pdf_path}.{uuid.uuid4().hex}.tmp"
+    c = canvas.Canvas(tmp_path, pagesize=A4)
+    width, height = A4
+    
+    # Maquetación fija; a continuación solo se dibujan los datos
+    _draw_pdf_layout(c)
+    
+    # Información de la factura
+    _draw_text_block(c, height - 80, (
+        f"Número de Factura: {data['invoice_number']}",
+        f"Fecha: {data['invoice_date_display']}",
+    ))
+    
+    # Información del vendedor
+    y_pos = height - 140
+    seller = data['seller_info']
+    _draw_text_block(c, y_pos - 20, (
+        f"Nombre: {seller.get('name', '')}",
+        f"NIT/Tax Code: {seller.get('tax_code', '')}",
+        f"Dirección: {seller.get('address', '')}",
+        f"Teléfono: {seller.get('phone', '')} | Email: {seller.get('email', '')}",
+    ))
+    
+    # Información del comprador
+    y_pos = y_pos - 100
+    buyer = data['buyer_info']
+    _draw_text_block(c, y_pos - 20, (
+        f"Nombre: {buyer.get('name', '')}",
+        f"NIT/Tax Code: {buyer.get('tax_code', '')}",
+        f"Dirección: {buyer.get('address', '')}",
+    ))
+    
+    # Tabla de productos/servicios
+    y_pos = _draw_items_table(c, data['items'], y_pos - 95)
+    
+    # Línea antes de totales
+    c.line(50, y_pos - 5, width - 50, y_pos - 5)
+    
+    # Totales
+    currency = data['currency']
+    vat_label = f"IVA ({data['vat_rate'] * 100:.0f}%):"
+    y_pos -= 25
+    c.setFont("Helvetica", 10)
+    c.drawString(350, y_pos, "Subtotal:")
+    c.drawString(450, y_pos, f"{format_money(data['subtotal'])} {currency}")
+    
+    y_pos -= 20
+    c.drawString(350, y_pos, vat_label)
+    c.drawString(450, y_pos, f"{format_money(data['vat_amount'])} {currency}")
+    
+    y_pos -= 20
+    c.setFont("Helvetica-Bold", 12)
+    c.drawString(350, y_pos, "TOTAL:")
+    c.drawString(450, y_pos, f"{format_money(data['total'])} {currency}")
+    
+    # Método de pago
+    y_pos -= 40
+    c.setFont("Helvetica", 10)
+    c.drawString(50, y_pos, f"Método de Pago: {data['payment_method']}")
+    
+    # Notas
+    if data.get('notes'):
+        y_pos -= 30
+        c.drawString(50, y_pos, f"Notas: {data['notes']}")
+    
+    # Pie de página
+    _draw_text_block(c, 50, (
+        "Factura Electrónica Válida según Decreto 70/2025/ND-CP de Vietnam",
+        f"ID de Factura: {invoice_id}",
+    ), font_size=8)
+    
+    c.save()
+    os.replace(tmp_path, pdf_path)
+    return pdf_path
+
+
+def _pid_alive(pid):
+    """Indica si sigue vivo el proceso (worker) con ese pid"""
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
 
 class InvoiceGenerator:
     """
@@ -19,42 +238,238 @@ class InvoiceGenerator:
     
     def __init__(self, invoice_folder):
         self.invoice_folder = invoice_folder
+        # Snapshot completo + log de cambios (una línea JSON por registro)
         self.metadata_file = os.path.join(invoice_folder, 'invoices_metadata.json')
+        self.log_file = os.path.join(invoice_folder, 'invoices_metadata.jsonl')
+        # Último número de factura asignado
+        self.counter_file = os.path.join(invoice_folder, 'invoices_counter')
+        self._log_fh = open(self.log_file, 'ab')
+        self._lock = threading.RLock()
+        # Profundidad de _log_locked: el flock solo se toma/suelta en el nivel exterior
+        self._log_depth = 0
+        # Los PDF se generan en procesos aparte (ReportLab usa mucha CPU)
+        self._pdf_pool = ProcessPoolExecutor(
+            max_workers=PDF_WORKERS,
+            mp_context=multiprocessing.get_context(PDF_MP_CONTEXT)
+        )
+        # Registros modificados con flush=False, pendientes de escribir
+        self._pending = {}
+        # PDF en generación en este proceso: {id de factura: futuro}
+        self._pdf_futures = {}
+        # Lista serializada en caché (se reconstruye cuando _dirty es True)
+        self._cache_bytes = None
+        self._cache_etag = None
+        self._dirty = True
         self._load_metadata()
     
     def _load_metadata(self):
-        """Carga metadatos de facturas"""
-        if os.path.exists(self.metadata_file):
-            with open(self.metadata_file, 'r', encoding='utf-8') as f:
-                self.invoices = json.load(f)
-        else:
+        """Carga el snapshot de facturas y aplica el log de cambios"""
+        with self._lock:
             self.invoices = {}
-            self._save_metadata()
+            if os.path.exists(self.metadata_file):
+                self.invoices = self._read_snapshot()
+            self._snapshot_stamp = self._file_stamp(self.metadata_file)
+            self._log_offset = 0
+            self._replay_log()
+            self.invoices.update(self._pending)
+            self._settle_orphan_pdfs()
+            self._dirty = True
+    
+    def _settle_orphan_pdfs(self):
+        """
+        PDF 'pending' sin generación en curso en este proceso (p. ej. el
+        worker que lo generaba se reinició): si el archivo ya existe se da
+        por listo; si no, se marca como diferido para que se genere al pedirlo
+        """
+        for invoice_id, invoice in self.invoices.items():
+            if invoice.get('pdf_status') != 'pending' or invoice_id in self._pdf_futures:
+                continue
+            if invoice.get('pdf_path') and os.path.exists(invoice['pdf_path']):
+                invoice['pdf_status'] = 'ready'
+            else:
+                invoice['pdf_status'] = 'deferred'
+                invoice['pdf_path'] = None
+    
+    def _read_snapshot(self):
+        """Lee el snapshot mapeándolo en memoria, sin copia intermedia"""
+        with open(self.metadata_file, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return {}
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                return orjson.loads(view)
+    
+    def _replay_log(self):
+        """Aplica las entradas del log escritas desde la última lectura"""
+        with open(self.log_file, 'rb') as f:
+            f.seek(self._log_offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break  # línea incompleta: escritura en curso
+                record = orjson.loads(line)
+                self.invoices[record['id']] = record
+                self._log_offset += len(line)
+                self._dirty = True
+    
+    @contextmanager
+    def _log_locked(self):
+        """Bloqueo exclusivo del log entre procesos (workers)"""
+        with self._lock:
+            if fcntl and self._log_depth == 0:
+                fcntl.flock(self._log_fh, fcntl.LOCK_EX)
+            self._log_depth += 1
+            try:
+                yield
+            finally:
+                self._log_depth -= 1
+                if fcntl and self._log_depth == 0:
+                    fcntl.flock(self._log_fh, fcntl.LOCK_UN)
+    
+    def _append_records(self, records):
+        """
+        Añade registros al log: una línea por factura creada o modificada
+        Evita reescribir todos los metadatos en cada cambio
+        """
+        with self._log_locked():
+            self.refresh()
+            data = b''.join(orjson.dumps(record) + b'\n' for record in records)
+            self._log_fh.write(data)
+            self._log_fh.flush()
+            self._log_offset += len(data)
+            for record in records:
+                self.invoices[record['id']] = record
+                self._pending.pop(record['id'], None)
+            self._dirty = True
+            if self._log_offset > LOG_COMPACT_BYTES:
+                self.compact()
+    
+    def _save_record(self, record, flush):
+        """Guarda un registro ahora o lo deja pendiente hasta flush()"""
+        with self._lock:
+            self.invoices[record['id']] = record
+            if flush:
+                self._append_records([record])
+            else:
+                self._pending[record['id']] = record
+                self._dirty = True
+    
+    def compact(self):
+        """Reescribe el snapshot con todas las facturas y vacía el log"""
+        with self._log_locked():
+            self.refresh()
+            tmp_path = self.metadata_file + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(orjson.dumps(self.invoices))
+            os.replace(tmp_path, self.metadata_file)
+            self._log_fh.truncate(0)
+            self._snapshot_stamp = self._file_stamp(self.metadata_file)
+            self._log_offset = 0
     
-    def _save_metadata(self):
-        """Guarda metadatos de facturas"""
-        with open(self.metadata_file, 'w', encoding='utf-8') as f:
-            json.dump(self.invoices, f, indent=2, ensure_ascii=False)
+    def _file_stamp(self, path):
+        """Marca (inodo, mtime, tamaño) de un archivo, None si no existe"""
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
     
-    def create_invoice(self, data):
+    def refresh(self):
+        """Recarga los metadatos si otro proceso (otro worker) los modificó"""
+        with self._lock:
+            log_size = os.fstat(self._log_fh.fileno()).st_size
+            if (self._file_stamp(self.metadata_file) != self._snapshot_stamp
+                    or log_size < self._log_offset):
+                # Otro worker compactó el log
+                self._load_metadata()
+            elif log_size > self._log_offset:
+                self._replay_log()
+    
+    def flush(self):
+        """Persiste los metadatos pendientes (tras operaciones con flush=False)"""
+        with self._lock:
+            if self._pending:
+                self._append_records(list(self._pending.values()))
+    
+    def create_invoice(self, data, flush=True, eager=EAGER_FILES):
         """
         Crea factura electrónica en formato XML y PDF
         Cumple con requisitos del Decreto 70/2025/ND-CP
+        Con flush=False los metadatos no se guardan hasta llamar a flush()
+        Los archivos que no estén en eager se generan al pedir su ruta
+        """
+        sequence = self._reserve_numbers(1)
+        
+        record, pdf_future = self._build_invoice_record(data, sequence, eager)
+        
+        # Guardar metadata
+        self._save_record(record, flush)
+        self._watch_pdf(record['id'], pdf_future)
+        
+        return self._creation_result(record)
+    
+    def create_invoices_batch(self, data_list, eager=EAGER_FILES):
+        """
+        Crea un lote de facturas escribiendo sus metadatos de una sola vez al final
+        """
+        base = self._reserve_numbers(len(data_list)) - 1
+        
+        built = [
+            self._build_invoice_record(data, base + idx, eager)
+            for idx, data in enumerate(data_list, 1)
+        ]
+        records = [record for record, _ in built]
+        
+        self._append_records(records)
+        for record, pdf_future in built:
+            self._watch_pdf(record['id'], pdf_future)
+        
+        return [self._creation_result(record) for record in records]
+    
+    def _reserve_numbers(self, count):
+        """
+        Reserva count números de factura consecutivos y devuelve el primero
+        El contador se guarda en disco y se comparte entre workers, así dos
+        facturas creadas a la vez nunca reciben el mismo número
+        """
+        with self._log_locked():
+            try:
+                with open(self.counter_file, 'r', encoding='utf-8') as f:
+                    last = int(f.read())
+            except FileNotFoundError:
+                # Primera vez: continuar tras las facturas existentes
+                self.refresh()
+                last = len(self.invoices)
+            tmp_path = self.counter_file + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(str(last + count))
+            os.replace(tmp_path, self.counter_file)
+        return last + 1
+    
+    def _build_invoice_record(self, data, sequence, eager=EAGER_FILES):
+        """
+        Genera el XML de una factura, encarga su PDF al pool de procesos
+        y construye su registro de metadatos
+        Devuelve (registro, futuro del PDF o None si el PDF se difiere)
         """
         invoice_id = str(uuid.uuid4())
-        invoice_number = f"INV-{datetime.now().strftime('%Y%m%d')}-{len(self.invoices) + 1:05d}"
+        # Fecha y sus formatos calculados una sola vez por factura
         invoice_date = datetime.now()
-        
-        # Calcular totales
-        subtotal = sum(item['quantity'] * item['unit_price'] for item in data['items'])
+        invoice_date_iso = invoice_date.isoformat()
+        invoice_number = f"INV-{invoice_date.strftime('%Y%m%d')}-{sequence:05d}"
+        
+        # Calcular totales con Decimal (sin errores de redondeo de float)
+        # Importe de cada línea: se guarda en el item y se reutiliza en XML y PDF
+        for item in data['items']:
+            item['amount'] = to_money(Decimal(str(item['quantity'])) * Decimal(str(item['unit_price'])))
+        subtotal = sum((item['amount'] for item in data['items']), Decimal('0'))
         vat_rate = data.get('vat_rate', 0.10)  # 10% VAT por defecto en Vietnam
-        vat_amount = subtotal * vat_rate
+        vat_amount = to_money(subtotal * Decimal(str(vat_rate)))
         total = subtotal + vat_amount
         
         invoice_data = {
             'id': invoice_id,
             'invoice_number': invoice_number,
-            'invoice_date': invoice_date.isoformat(),
+            'invoice_date': invoice_date_iso,
+            'invoice_date_display': invoice_date.strftime('%d/%m/%Y %H:%M'),
             'seller_info': data['seller_info'],
             'buyer_info': data['buyer_info'],
             'items': data['items'],
@@ -68,213 +483,246 @@ class InvoiceGenerator:
         }
         
         # Generar XML (formato requerido por autoridades vietnamitas)
-        xml_path = self._generate_xml(invoice_id, invoice_data)
-        
-        # Generar PDF (para el cliente)
-        pdf_path = self._generate_pdf(invoice_id, invoice_data)
-        
-        # Guardar metadata
-        self.invoices[invoice_id] = {
+        xml_path = None
+        if 'xml' in eager:
+            xml_path = self._generate_xml(invoice_id, invoice_data)
+        
+        # Generar PDF (para el cliente) en segundo plano
+        pdf_path, pdf_future, pdf_status = None, None, 'deferred'
+        if 'pdf' in eager:
+            pdf_path = os.path.join(self.invoice_folder, f"{invoice_id}.pdf")
+            pdf_future = self._pdf_pool.submit(
+                _generate_pdf_standalone, invoice_id, invoice_data, self.invoice_folder
+            )
+            pdf_status = 'pending'
+        
+        # Los metadatos JSON guardan los importes (ya redondeados) como números
+        items = [{**item, 'amount': float(item['amount'])} for item in data['items']]
+        
+        record = {
             **invoice_data,
+            'items': items,
+            'subtotal': float(subtotal),
+            'vat_amount': float(vat_amount),
+            'total': float(total),
             'xml_path': xml_path,
             'pdf_path': pdf_path,
+            'pdf_status': pdf_status,
             'status': 'generated',
-            'created_at': invoice_date.isoformat()
+            'created_at': invoice_date_iso
         }
-        self._save_metadata()
-        
+        return record, pdf_future
+    
+    def _watch_pdf(self, invoice_id, pdf_future):
+        """
+        Actualiza pdf_status cuando termina la generación del PDF
+        Si falla, se borra pdf_path para que se vuelva a generar al pedirlo
+        El resultado siempre se guarda en disco, salvo que el registro siga
+        pendiente de flush() (entonces se escribe junto con él)
+        """
+        if pdf_future is None:
+            return
+        self._pdf_futures[invoice_id] = pdf_future
+        def on_done(future):
+            if future.exception():
+                changes = {'pdf_status': 'failed', 'pdf_path': None}
+            else:
+                changes = {'pdf_status': 'ready'}
+            with self._lock:
+                self._pdf_futures.pop(invoice_id, None)
+                self._update_invoice(invoice_id, changes, flush=invoice_id not in self._pending)
+        pdf_future.add_done_callback(on_done)
+    
+    def _creation_result(self, record):
+        """Respuesta devuelta al crear una factura"""
         return {
             'success': True,
-            'invoice_id': invoice_id,
-            'invoice_number': invoice_number,
-            'xml_path': xml_path,
-            'pdf_path': pdf_path,
-            'total': total
+            'invoice_id': record['id'],
+            'invoice_number': record['invoice_number'],
+            'xml_path': record['xml_path'],
+            'pdf_path': record['pdf_path'],
+            'total': record['total']
         }
     
     def _generate_xml(self, invoice_id, data):
         """
         Genera factura en formato XML según estándares vietnamitas
         Formato basado en Decreto 123/2020/ND-CP y Decreto 70/2025/ND-CP
+        Los elementos se escriben directamente al archivo, sin construir el árbol
         """
-        # Crear estructura XML
-        invoice = ET.Element('Invoice')
-        invoice.set('xmlns', 'http://www.gdt.gov.vn/einvoice')
-        invoice.set('version', '2.0')
-        
-        # Información general
-        general_info = ET.SubElement(invoice, 'GeneralInformation')
-        ET.SubElement(general_info, 'InvoiceNumber').text = data['invoice_number']
-        ET.SubElement(general_info, 'InvoiceDate').text = data['invoice_date']
-        ET.SubElement(general_info, 'Currency').text = data['currency']
-        ET.SubElement(general_info, 'ExchangeRate').text = '1'
-        
-        # Información del vendedor
-        seller = ET.SubElement(invoice, 'Seller')
+        xml_path = os.path.join(self.invoice_folder, f"{invoice_id}.xml")
+        tmp_path = f"{xml_path}.{uuid.uuid4().hex}.tmp"
         seller_info = data['seller_info']
-        ET.SubElement(seller, 'TaxCode').text = seller_info.get('tax_code', '')
-        ET.SubElement(seller, 'LegalName').text = seller_info.get('name', '')
-        ET.SubElement(seller, 'Address').text = seller_info.get('address', '')
-        ET.SubElement(seller, 'Phone').text = seller_info.get('phone', '')
-        ET.SubElement(seller, 'Email').text = seller_info.get('email', '')
-        
-        # Información del comprador
-        buyer = ET.SubElement(invoice, 'Buyer')
         buyer_info = data['buyer_info']
-        ET.SubElement(buyer, 'TaxCode').text = buyer_info.get('tax_code', '')
-        ET.SubElement(buyer, 'Name').text = buyer_info.get('name', '')
-        ET.SubElement(buyer, 'Address').text = buyer_info.get('address', '')
-        ET.SubElement(buyer, 'Phone').text = buyer_info.get('phone', '')
-        ET.SubElement(buyer, 'Email').text = buyer_info.get('email', '')
-        
-        # Detalle de productos/servicios
-        items_section = ET.SubElement(invoice, 'Items')
-        for idx, item in enumerate(data['items'], 1):
-            item_elem = ET.SubElement(items_section, 'Item')
-            ET.SubElement(item_elem, 'LineNumber').text = str(idx)
-            ET.SubElement(item_elem, 'Description').text = item['description']
-            ET.SubElement(item_elem, 'Quantity').text = str(item['quantity'])
-            ET.SubElement(item_elem, 'UnitPrice').text = str(item['unit_price'])
-            ET.SubElement(item_elem, 'Amount').text = str(item['quantity'] * item['unit_price'])
-            ET.SubElement(item_elem, 'VATRate').text = str(data['vat_rate'] * 100)
-        
-        # Totales
-        summary = ET.SubElement(invoice, 'Summary')
-        ET.SubElement(summary, 'Subtotal').text = str(data['subtotal'])
-        ET.SubElement(summary, 'VATAmount').text = str(data['vat_amount'])
-        ET.SubElement(summary, 'Total').text = str(data['total'])
-        
-        # Información de pago
-        payment = ET.SubElement(invoice, 'PaymentInformation')
-        ET.SubElement(payment, 'PaymentMethod').text = data['payment_method']
-        
-        # Guardar XML formateado
-        xml_string = minidom.parseString(ET.tostring(invoice)).toprettyxml(indent="  ")
-        xml_path = os.path.join(self.invoice_folder, f"{invoice_id}.xml")
-        
-        with open(xml_path, 'w', encoding='utf-8') as f:
-            f.write(xml_string)
         
+        with etree.xmlfile(tmp_path, encoding='utf-8') as xf:
+            xf.write_declaration()
+            with xf.element(_xml_tag('Invoice'), nsmap=XML_NSMAP, attrib={'version': '2.0'}):
+                # Información general
+                self._write_xml_section(xf, 'GeneralInformation', (
+                    ('InvoiceNumber', data['invoice_number']),
+                    ('InvoiceDate', data['invoice_date']),
+                    ('Currency', data['currency']),
+                    ('ExchangeRate', '1'),
+                ))
+                
+                # Información del vendedor
+                self._write_xml_section(xf, 'Seller', (
+                    ('TaxCode', seller_info.get('tax_code')),
+                    ('LegalName', seller_info.get('name')),
+                    ('Address', seller_info.get('address')),
+                    ('Phone', seller_info.get('phone')),
+                    ('Email', seller_info.get('email')),
+                ))
+                
+                # Información del comprador
+                self._write_xml_section(xf, 'Buyer', (
+                    ('TaxCode', buyer_info.get('tax_code')),
+                    ('Name', buyer_info.get('name')),
+                    ('Address', buyer_info.get('address')),
+                    ('Phone', buyer_info.get('phone')),
+                    ('Email', buyer_info.get('email')),
+                ))
+                
+                # Detalle de productos/servicios (un elemento Item a la vez)
+                vat_rate = str(data['vat_rate'] * 100)
+                with xf.element(_xml_tag('Items')):
+                    for idx, item in enumerate(data['items'], 1):
+                        self._write_xml_section(xf, 'Item', (
+                            ('LineNumber', str(idx)),
+                            ('Description', item['description']),
+                            ('Quantity', str(item['quantity'])),
+                            ('UnitPrice', str(item['unit_price'])),
+                            ('Amount', str(item['amount'])),
+                            ('VATRate', vat_rate),
+                        ))
+                        xf.flush()
+                
+                # Totales
+                self._write_xml_section(xf, 'Summary', (
+                    ('Subtotal', str(data['subtotal'])),
+                    ('VATAmount', str(data['vat_amount'])),
+                    ('Total', str(data['total'])),
+                ))
+                
+                # Información de pago
+                self._write_xml_section(xf, 'PaymentInformation', (
+                    ('PaymentMethod', data['payment_method']),
+                ))
+        
+        os.replace(tmp_path, xml_path)
         return xml_path
     
-    def _generate_pdf(self, invoice_id, data):
-        """Genera PDF de la factura para el cliente"""
-        pdf_path = os.path.join(self.invoice_folder, f"{invoice_id}.pdf")
-        c = canvas.Canvas(pdf_path, pagesize=A4)
-        width, height = A4
-        
-        # Título
-        c.setFont("Helvetica-Bold", 20)
-        c.drawString(50, height - 50, "FACTURA ELECTRÓNICA / E-INVOICE")
-        
-        # Información de la factura
-        c.setFont("Helvetica", 10)
-        c.drawString(50, height - 80, f"Número de Factura: {data['invoice_number']}")
-        c.drawString(50, height - 95, f"Fecha: {datetime.fromisoformat(data['invoice_date']).strftime('%d/%m/%Y %H:%M')}")
-        
-        # Línea separadora
-        c.line(50, height - 110, width - 50, height - 110)
-        
-        # Información del vendedor
-        y_pos = height - 140
-        c.setFont("Helvetica-Bold", 12)
-        c.drawString(50, y_pos, "VENDEDOR:")
-        c.setFont("Helvetica", 10)
-        seller = data['seller_info']
-        c.drawString(50, y_pos - 20, f"Nombre: {seller.get('name', '')}")
-        c.drawString(50, y_pos - 35, f"NIT/Tax Code: {seller.get('tax_code', '')}")
-        c.drawString(50, y_pos - 50, f"Dirección: {seller.get('address', '')}")
-        c.drawString(50, y_pos - 65, f"Teléfono: {seller.get('phone', '')} | Email: {seller.get('email', '')}")
-        
-        # Información del comprador
-        y_pos = y_pos - 100
-        c.setFont("Helvetica-Bold", 12)
-        c.drawString(50, y_pos, "CLIENTE:")
-        c.setFont("Helvetica", 10)
-        buyer = data['buyer_info']
-        c.drawString(50, y_pos - 20, f"Nombre: {buyer.get('name', '')}")
-        c.drawString(50, y_pos - 35, f"NIT/Tax Code: {buyer.get('tax_code', '')}")
-        c.drawString(50, y_pos - 50, f"Dirección: {buyer.get('address', '')}")
-        
-        # Tabla de productos/servicios
-        y_pos = y_pos - 90
-        c.setFont("Helvetica-Bold", 10)
-        c.drawString(50, y_pos, "DETALLE DE PRODUCTOS/SERVICIOS:")
-        
-        # Encabezados de tabla
-        y_pos -= 20
-        c.drawString(50, y_pos, "#")
-        c.drawString(80, y_pos, "Descripción")
-        c.drawString(300, y_pos, "Cant.")
-        c.drawString(350, y_pos, "Precio Unit.")
-        c.drawString(450, y_pos, "Total")
-        
-        c.line(50, y_pos - 5, width - 50, y_pos - 5)
-        
-        # Items
-        c.setFont("Helvetica", 9)
-        y_pos -= 20
-        for idx, item in enumerate(data['items'], 1):
-            if y_pos < 150:  # Nueva página si es necesario
-                c.showPage()
-                y_pos = height - 50
-            
-            c.drawString(50, y_pos, str(idx))
-            c.drawString(80, y_pos, item['description'][:30])
-            c.drawString(300, y_pos, str(item['quantity']))
-            c.drawString(350, y_pos, f"{item['unit_price']:,.2f}")
-            c.drawString(450, y_pos, f"{item['quantity'] * item['unit_price']:,.2f}")
-            y_pos -= 15
-        
-        # Línea antes de totales
-        c.line(50, y_pos - 5, width - 50, y_pos - 5)
-        
-        # Totales
-        y_pos -= 25
-        c.setFont("Helvetica", 10)
-        c.drawString(350, y_pos, "Subtotal:")
-        c.drawString(450, y_pos, f"{data['subtotal']:,.2f} {data['currency']}")
-        
-        y_pos -= 20
-        c.drawString(350, y_pos, f"IVA ({data['vat_rate']*100:.0f}%):")
-        c.drawString(450, y_pos, f"{data['vat_amount']:,.2f} {data['currency']}")
-        
-        y_pos -= 20
-        c.setFont("Helvetica-Bold", 12)
-        c.drawString(350, y_pos, "TOTAL:")
-        c.drawString(450, y_pos, f"{data['total']:,.2f} {data['currency']}")
-        
-        # Método de pago
-        y_pos -= 40
-        c.setFont("Helvetica", 10)
-        c.drawString(50, y_pos, f"Método de Pago: {data['payment_method']}")
-        
-        # Notas
-        if data.get('notes'):
-            y_pos -= 30
-            c.drawString(50, y_pos, f"Notas: {data['notes']}")
-        
-        # Pie de página
-        c.setFont("Helvetica", 8)
-        c.drawString(50, 50, "Factura Electrónica Válida según Decreto 70/2025/ND-CP de Vietnam")
-        c.drawString(50, 35, f"ID de Factura: {invoice_id}")
-        
-        c.save()
-        return pdf_path
+    def _write_xml_section(self, xf, tag, fields):
+        """
+        Escribe un elemento con sus campos (etiqueta, texto) como hijos
+        Los campos vacíos se omiten
+        """
+        with xf.element(_xml_tag(tag)):
+            for field, text in fields:
+                if text:
+                    with xf.element(_xml_tag(field)):
+                        xf.write(str(text))
     
     def get_invoice(self, invoice_id):
         """Obtiene información de una factura"""
         return self.invoices.get(invoice_id)
     
+    def _update_invoice(self, invoice_id, changes, flush=True):
+        """Aplica cambios a los metadatos de una factura"""
+        with self._lock:
+            if flush:
+                self.refresh()
+            invoice = self.invoices.get(invoice_id)
+            if invoice:
+                invoice.update(changes)
+                self._save_record(invoice, flush)
+    
+    def mark_signed(self, invoice_id, signature_result, flush=True):
+        """Registra la firma de una factura"""
+        self._update_invoice(invoice_id, {
+            'status': 'signed',
+            'is_signed': True,
+            'signature_id': signature_result.get('signature_id'),
+            'signature_timestamp': signature_result.get('timestamp')
+        }, flush)
+    
+    def set_status(self, invoice_id, status, flush=True):
+        """Actualiza el estado de una factura (p. ej. 'signature_failed')"""
+        self._update_invoice(invoice_id, {'status': status}, flush)
+    
+    def start_signing(self, invoice_id, flush=True):
+        """Marca una factura en firma por este proceso (worker)"""
+        self._update_invoice(invoice_id, {'status': 'signing', 'signing_pid': os.getpid()}, flush)
+    
+    def claim_stalled_signing(self):
+        """
+        Reclama las facturas en 'signing' cuyo worker ya no existe
+        (se reinició antes de terminar la firma) y devuelve sus ids
+        Se hace con el log bloqueado para que solo un worker las reclame
+        """
+        with self._log_locked():
+            self.refresh()
+            stalled = [
+                invoice for invoice in self.invoices.values()
+                if invoice.get('status') == 'signing'
+                and not _pid_alive(invoice.get('signing_pid'))
+            ]
+            for invoice in stalled:
+                invoice['signing_pid'] = os.getpid()
+            if stalled:
+                self._append_records(stalled)
+        return [invoice['id'] for invoice in stalled]
+    
     def get_invoice_pdf_path(self, invoice_id):
-        """Obtiene la ruta del PDF de una factura"""
-        invoice = self.invoices.get(invoice_id)
-        return invoice['pdf_path'] if invoice else None
+        """Obtiene la ruta del PDF de una factura (lo genera si se difirió)"""
+        return self._ensure_file(invoice_id, 'pdf')
     
     def get_invoice_xml_path(self, invoice_id):
-        """Obtiene la ruta del XML de una factura"""
+        """Obtiene la ruta del XML de una factura (lo genera si se difirió)"""
+        return self._ensure_file(invoice_id, 'xml')
+    
+    def _ensure_file(self, invoice_id, file_type):
+        """Ruta del XML/PDF de una factura; si no se generó al crearla, se genera ahora"""
         invoice = self.invoices.get(invoice_id)
-        return invoice['xml_path'] if invoice else None
+        if not invoice:
+            return None
+        path = invoice.get(f'{file_type}_path')
+        if path:
+            return path
+        
+        data = self._document_data(invoice)
+        if file_type == 'xml':
+            path = self._generate_xml(invoice_id, data)
+            changes = {'xml_path': path}
+        else:
+            path = _generate_pdf_standalone(invoice_id, data, self.invoice_folder)
+            changes = {'pdf_path': path, 'pdf_status': 'ready'}
+        self._update_invoice(invoice_id, changes)
+        return path
+    
+    def _document_data(self, invoice):
+        """Datos de la factura con los importes en Decimal, como al crearla"""
+        data = dict(invoice)
+        data['items'] = [
+            {**item, 'amount': to_money(Decimal(str(item['amount'])))}
+            for item in invoice['items']
+        ]
+        for key in ('subtotal', 'vat_amount', 'total'):
+            data[key] = to_money(Decimal(str(invoice[key])))
+        return data
+    
+    def list_invoices_snapshot(self):
+        """
+        Lista de facturas serializada en JSON y su ETag
+        Solo se vuelve a serializar si las facturas cambiaron
+        """
+        with self._lock:
+            if self._dirty:
+                self._cache_bytes = orjson.dumps({'invoices': list(self.invoices.values())})
+                self._cache_etag = hashlib.sha256(self._cache_bytes).hexdigest()
+                self._dirty = False
+            return self._cache_bytes, self._cache_etag
     
     def list_all_invoices(self):
         """Lista todas las facturas"""
@@ -283,3 +731,13 @@ class InvoiceGenerator:
     def get_invoice_count(self):
         """Obtiene el total de facturas"""
         return len(self.invoices)
+
+
+@lru_cache(maxsize=None)
+def get_invoice_generator(invoice_folder):
+    """
+    Generador compartido por carpeta de facturas
+    Evita releer los metadatos al crear un InvoiceGenerator en cada petición;
+    los cambios de otros procesos se recogen con refresh()
+    """
+    return InvoiceGenerator(invoice_folder)
@@ -1,10 +1,41 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Text, Boolean, ForeignKey
+from sqlalchemy import create_engine, event, Column, Integer, String, Float, Numeric, DateTime, Text, Boolean, ForeignKey, Index
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.orm import relationship, sessionmaker, selectinload
 from datetime import datetime
-import json
+from decimal import Decimal
+import os
+import orjson
 
-Base = declarative_base()
+class SerializableMixin:
+    """
+    to_dict genérico a partir de las columnas mapeadas
+    Las fechas se devuelven como datetime (orjson las serializa directamente)
+    y los importes Numeric como números JSON
+    """
+    # Columnas que no se exponen en to_dict
+    _dict_exclude = frozenset()
+    
+    def to_dict(self):
+        """Convierte el modelo a diccionario"""
+        data = {}
+        for column in self.__mapper__.column_attrs:
+            if column.key in self._dict_exclude:
+                continue
+            value = getattr(self, column.key)
+            data[column.key] = float(value) if isinstance(value, Decimal) else value
+        return data
+
+
+Base = declarative_base(cls=SerializableMixin)
+
+# PRAGMAs aplicados a cada conexión SQLite
+SQLITE_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA mmap_size=268435456',
+    'PRAGMA cache_size=-65536',
+)
 
 class Document(Base):
     """
@@ -12,17 +43,18 @@ class Document(Base):
     Almacena metadatos y referencias a archivos físicos
     """
     __tablename__ = 'documents'
+    _dict_exclude = frozenset({'modified_date'})
     
     id = Column(String(36), primary_key=True)
     original_filename = Column(String(255), nullable=False)
     stored_filename = Column(String(255), nullable=False, unique=True)
     title = Column(String(255), nullable=False)
-    category = Column(String(100), default='general')
+    category = Column(String(100), default='general', index=True)
     description = Column(Text)
     tags = Column(Text)  # Almacenado como JSON string
-    upload_date = Column(DateTime, default=datetime.utcnow)
+    upload_date = Column(DateTime, default=datetime.utcnow, index=True)
     file_size = Column(Integer)
-    file_hash = Column(String(64))  # SHA256 hash
+    file_hash = Column(String(64), index=True)  # SHA256 hash
     file_extension = Column(String(10))
     version = Column(Integer, default=1)
     created_by = Column(String(100))
@@ -33,23 +65,10 @@ class Document(Base):
     versions = relationship("DocumentVersion", back_populates="document", cascade="all, delete-orphan")
     
     def to_dict(self):
-        """Convierte el modelo a diccionario"""
-        return {
-            'id': self.id,
-            'original_filename': self.original_filename,
-            'stored_filename': self.stored_filename,
-            'title': self.title,
-            'category': self.category,
-            'description': self.description,
-            'tags': json.loads(self.tags) if self.tags else [],
-            'upload_date': self.upload_date.isoformat() if self.upload_date else None,
-            'file_size': self.file_size,
-            'file_hash': self.file_hash,
-            'file_extension': self.file_extension,
-            'version': self.version,
-            'created_by': self.created_by,
-            'is_active': self.is_active
-        }
+        """Convierte el modelo a diccionario (tags decodificados de JSON)"""
+        data = super().to_dict()
+        data['tags'] = orjson.loads(self.tags) if self.tags else []
+        return data
 
 
 class DocumentVersion(Base):
@@ -58,9 +77,10 @@ class DocumentVersion(Base):
     Mantiene historial de cambios
     """
     __tablename__ = 'document_versions'
+    _dict_exclude = frozenset({'stored_filename', 'file_hash'})
     
     id = Column(Integer, primary_key=True, autoincrement=True)
-    document_id = Column(String(36), ForeignKey('documents.id'), nullable=False)
+    document_id = Column(String(36), ForeignKey('documents.id'), nullable=False, index=True)
     version_number = Column(Integer, nullable=False)
     stored_filename = Column(String(255), nullable=False)
     file_hash = Column(String(64))
@@ -70,28 +90,26 @@ class DocumentVersion(Base):
     
     # Relación con documento principal
     document = relationship("Document", back_populates="versions")
-    
-    def to_dict(self):
-        return {
-            'id': self.id,
-            'document_id': self.document_id,
-            'version_number': self.version_number,
-            'created_date': self.created_date.isoformat() if self.created_date else None,
-            'created_by': self.created_by,
-            'change_notes': self.change_notes
-        }
 
 
+# Claves de los datos de vendedor y comprador en Invoice.to_dict
+PARTY_INFO_KEYS = ('name', 'tax_code', 'address', 'phone', 'email')
+
 class Invoice(Base):
     """
     Modelo de factura electrónica
     Cumple con Decreto 70/2025/ND-CP de Vietnam
     """
     __tablename__ = 'invoices'
+    # Vendedor y comprador se exponen agrupados en seller_info/buyer_info
+    _dict_exclude = frozenset(
+        [f'{party}_{key}' for party in ('seller', 'buyer') for key in PARTY_INFO_KEYS]
+        + ['xml_path', 'pdf_path', 'signature_id', 'created_by']
+    )
     
     id = Column(String(36), primary_key=True)
-    invoice_number = Column(String(50), unique=True, nullable=False)
-    invoice_date = Column(DateTime, default=datetime.utcnow, nullable=False)
+    invoice_number = Column(String(50), unique=True, nullable=False, index=True)
+    invoice_date = Column(DateTime, default=datetime.utcnow, nullable=False, index=True)
     
     # Información del vendedor
     seller_name = Column(String(255), nullable=False)
@@ -108,10 +126,10 @@ class Invoice(Base):
     buyer_email = Column(String(100))
     
     # Montos
-    subtotal = Column(Float, nullable=False)
+    subtotal = Column(Numeric(18, 2), nullable=False)
     vat_rate = Column(Float, default=0.10)
-    vat_amount = Column(Float, nullable=False)
-    total = Column(Float, nullable=False)
+    vat_amount = Column(Numeric(18, 2), nullable=False)
+    total = Column(Numeric(18, 2), nullable=False)
     currency = Column(String(10), default='VND')
     
     # Información adicional
@@ -123,51 +141,36 @@ class Invoice(Base):
     pdf_path = Column(String(500))
     
     # Estado y firma
-    status = Column(String(50), default='generated')
+    status = Column(String(50), default='generated', index=True)
     is_signed = Column(Boolean, default=False)
     signature_id = Column(String(100))
     signature_timestamp = Column(DateTime)
     
     # Auditoría
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
     created_by = Column(String(100))
     
     # Relación con items de factura
     items = relationship("InvoiceItem", back_populates="invoice", cascade="all, delete-orphan")
     
     def to_dict(self):
-        """Convierte el modelo a diccionario"""
-        return {
-            'id': self.id,
-            'invoice_number': self.invoice_number,
-            'invoice_date': self.invoice_date.isoformat() if self.invoice_date else None,
-            'seller_info': {
-                'name': self.seller_name,
-                'tax_code': self.seller_tax_code,
-                'address': self.seller_address,
-                'phone': self.seller_phone,
-                'email': self.seller_email
-            },
-            'buyer_info': {
-                'name': self.buyer_name,
-                'tax_code': self.buyer_tax_code,
-                'address': self.buyer_address,
-                'phone': self.buyer_phone,
-                'email': self.buyer_email
-            },
-            'subtotal': self.subtotal,
-            'vat_rate': self.vat_rate,
-            'vat_amount': self.vat_amount,
-            'total': self.total,
-            'currency': self.currency,
-            'payment_method': self.payment_method,
-            'notes': self.notes,
-            'status': self.status,
-            'is_signed': self.is_signed,
-            'signature_timestamp': self.signature_timestamp.isoformat() if self.signature_timestamp else None,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'items': [item.to_dict() for item in self.items] if self.items else []
-        }
+        """
+        Convierte el modelo a diccionario
+        Los items solo se incluyen si ya están cargados (ver query_invoices)
+        """
+        data = super().to_dict()
+        data['seller_info'] = dict(zip(PARTY_INFO_KEYS, (
+            self.seller_name, self.seller_tax_code, self.seller_address,
+            self.seller_phone, self.seller_email
+        )))
+        data['buyer_info'] = dict(zip(PARTY_INFO_KEYS, (
+            self.buyer_name, self.buyer_tax_code, self.buyer_address,
+            self.buyer_phone, self.buyer_email
+        )))
+        # Evita una consulta perezosa por factura (N+1)
+        if 'items' in self.__dict__:
+            data['items'] = [item.to_dict() for item in self.items]
+        return data
 
 
 class InvoiceItem(Base):
@@ -176,29 +179,19 @@ class InvoiceItem(Base):
     Detalle de productos/servicios
     """
     __tablename__ = 'invoice_items'
+    _dict_exclude = frozenset({'invoice_id'})
     
     id = Column(Integer, primary_key=True, autoincrement=True)
-    invoice_id = Column(String(36), ForeignKey('invoices.id'), nullable=False)
+    invoice_id = Column(String(36), ForeignKey('invoices.id'), nullable=False, index=True)
     line_number = Column(Integer, nullable=False)
     description = Column(String(500), nullable=False)
     quantity = Column(Float, nullable=False)
-    unit_price = Column(Float, nullable=False)
-    amount = Column(Float, nullable=False)
+    unit_price = Column(Numeric(18, 2), nullable=False)
+    amount = Column(Numeric(18, 2), nullable=False)
     unit_of_measure = Column(String(50))
     
     # Relación con factura
     invoice = relationship("Invoice", back_populates="items")
-    
-    def to_dict(self):
-        return {
-            'id': self.id,
-            'line_number': self.line_number,
-            'description': self.description,
-            'quantity': self.quantity,
-            'unit_price': self.unit_price,
-            'amount': self.amount,
-            'unit_of_measure': self.unit_of_measure
-        }
 
 
 class DigitalSignature(Base):
@@ -207,9 +200,13 @@ class DigitalSignature(Base):
     Cumple con Ley ETL No.20/2023/QH15
     """
     __tablename__ = 'digital_signatures'
+    _dict_exclude = frozenset({
+        'signature_data', 'document_hash', 'certificate_serial',
+        'certificate_issuer', 'created_at', 'verified_at'
+    })
     
     id = Column(Integer, primary_key=True, autoincrement=True)
-    signature_id = Column(String(100), unique=True, nullable=False)
+    signature_id = Column(String(100), unique=True, nullable=False, index=True)
     document_path = Column(String(500), nullable=False)
     document_type = Column(String(50))  # 'invoice', 'document', etc.
     
@@ -220,7 +217,7 @@ class DigitalSignature(Base):
     
     # Datos de la firma
     signature_data = Column(Text, nullable=False)  # Base64 encoded
-    document_hash = Column(String(64), nullable=False)
+    document_hash = Column(String(64), nullable=False, index=True)
     algorithm = Column(String(50), default='RSA-PSS-SHA256')
     key_size = Column(Integer, default=2048)
     
@@ -236,22 +233,6 @@ class DigitalSignature(Base):
     # Auditoría
     created_at = Column(DateTime, default=datetime.utcnow)
     verified_at = Column(DateTime)
-    
-    def to_dict(self):
-        return {
-            'id': self.id,
-            'signature_id': self.signature_id,
-            'document_path': self.document_path,
-            'document_type': self.document_type,
-            'signer_name': self.signer_name,
-            'signer_email': self.signer_email,
-            'signer_tax_code': self.signer_tax_code,
-            'algorithm': self.algorithm,
-            'key_size': self.key_size,
-            'status': self.status,
-            'timestamp': self.timestamp.isoformat() if self.timestamp else None,
-            'valid_until': self.valid_until.isoformat() if self.valid_until else None
-        }
 
 
 class AuditLog(Base):
@@ -260,9 +241,14 @@ class AuditLog(Base):
     Registra todas las acciones del sistema
     """
     __tablename__ = 'audit_logs'
+    _dict_exclude = frozenset({'user_agent'})
+    __table_args__ = (
+        # Búsqueda de la auditoría de una entidad concreta
+        Index('ix_audit_entity', 'entity_type', 'entity_id'),
+    )
     
     id = Column(Integer, primary_key=True, autoincrement=True)
-    timestamp = Column(DateTime, default=datetime.utcnow, nullable=False)
+    timestamp = Column(DateTime, default=datetime.utcnow, nullable=False, index=True)
     user = Column(String(100))
     action = Column(String(100), nullable=False)
     entity_type = Column(String(50))
@@ -270,30 +256,33 @@ class AuditLog(Base):
     details = Column(Text)
     ip_address = Column(String(50))
     user_agent = Column(String(255))
-    
-    def to_dict(self):
-        return {
-            'id': self.id,
-            'timestamp': self.timestamp.isoformat() if self.timestamp else None,
-            'user': self.user,
-            'action': self.action,
-            'entity_type': self.entity_type,
-            'entity_id': self.entity_id,
-            'details': self.details,
-            'ip_address': self.ip_address
-        }
 
 
 # Función para inicializar la base de datos
 def init_db(database_url='sqlite:///mipyme.db'):
     """
     Inicializa la base de datos con todas las tablas
+    El registro de cada sentencia SQL solo se activa con SQL_ECHO=1
     """
-    engine = create_engine(database_url, echo=True)
+    engine = create_engine(
+        database_url,
+        echo=os.getenv('SQL_ECHO') == '1',
+        pool_pre_ping=True
+    )
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine, 'connect', _set_sqlite_pragmas)
     Base.metadata.create_all(engine)
     return engine
 
 
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Ajustes de SQLite para escrituras pequeñas y frecuentes (WAL)"""
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
 # Crear sesión de base de datos
 def get_session(engine):
     """
@@ -303,6 +292,14 @@ def get_session(engine):
     return Session()
 
 
+def query_invoices(session):
+    """
+    Consulta de facturas con sus items cargados en una sola consulta IN (...)
+    en lugar de una consulta por factura
+    """
+    return session.query(Invoice).options(selectinload(Invoice.items))
+
+
 if __name__ == '__main__':
     # Inicializar base de datos
     engine = init_db()
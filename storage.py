@@ -0,0 +1,36 @@
+import os
+import orjson
+import sqlite3
+
+
+def open_database(db_path):
+    """
+    Abre una conexión SQLite para almacenes de metadatos
+    Modo autocommit + WAL: cada inserción es una escritura pequeña
+    en lugar de reescribir todo el archivo JSON
+    """
+    conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+def import_legacy_json(conn, table, json_path):
+    """
+    Importa una sola vez los registros del antiguo archivo JSON
+    a una tabla (id, json) vacía
+    """
+    if not os.path.exists(json_path):
+        return
+    if conn.execute(f'SELECT 1 FROM {table} LIMIT 1').fetchone():
+        return
+
+    with open(json_path, 'rb') as f:
+        records = orjson.loads(f.read())
+
+    conn.execute('BEGIN')
+    conn.executemany(
+        f'INSERT OR REPLACE INTO {table} (id, json) VALUES (?, ?)',
+        ((key, orjson.dumps(value).decode('utf-8')) for key, value in records.items())
+    )
+    conn.execute('COMMIT')
@@ -0,0 +1,3 @@
+# Punto de entrada WSGI para servidores de producción
+# Uso: gunicorn wsgi:app (ver gunicorn.conf.py)
+from app import app